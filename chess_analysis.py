@@ -1,106 +1,263 @@
 import os
 import sys
 import traceback
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
-import matplotlib.pyplot as plt
+import matplotlib
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+from pyspark import StorageLevel
 from pyspark.sql import SparkSession
 from pyspark.sql.functions import *
 from pyspark.sql.types import *
-from pyspark.sql.window import Window
-from pyspark.ml.feature import StringIndexer, VectorAssembler
-from pyspark.ml.clustering import KMeans
+
+# Derived category columns are stored as ByteType codes; these map them back to labels
+STRENGTH_LABELS = {0: "Master", 1: "Expert", 2: "Club", 3: "Beginner"}
+TIME_FORMAT_LABELS = {0: "Increment", 1: "Tournament", 2: "Standard"}
+
+# Bump whenever the cached Parquet layout or column types change
+PARQUET_CACHE_VERSION = 2
+
+def label_column(name, labels):
+    """Map an encoded category column back to its labels"""
+    mapping = create_map([lit(value) for item in labels.items() for value in item])
+    return mapping[col(name)]
+
+def collect_columns(df):
+    """Collect a small DataFrame into a dict of column lists, bypassing pandas"""
+    rows = df.collect()
+    return {name: [row[name] for row in rows] for name in df.columns}
+
+def histogram(df, name, lo, hi, bins):
+    """Bin a numeric column in Spark, returning (edges, counts) like RDD.histogram"""
+    width = (hi - lo) / bins or 1
+    # The maximum falls into the last bucket, matching RDD.histogram's closed last bin
+    bucket = least(floor((col(name) - lo) / width), lit(bins - 1)).cast("int")
+    rows = df.select(bucket.alias("bucket")).groupBy("bucket").count().collect()
+    counts = [0] * bins
+    for row in rows:
+        counts[row['bucket']] = row['count']
+    edges = [lo + i * width for i in range(bins + 1)]
+    return edges, counts
+
+def _render_chart(name, data, output_path):
+    """Render one collected aggregation to a PNG file"""
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    if name == 'strength_dist':
+        # 1. Player Strength Distribution
+        plt.figure(figsize=(12, 6))
+        plt.bar(data['StrengthCategory'], data['count'])
+        plt.title('Distribution of Player Strength Categories')
+        plt.xlabel('Strength Category')
+        plt.ylabel('Number of Players')
+        plt.xticks(rotation=45)
+        plt.tight_layout()
+        plt.savefig(os.path.join(output_path, 'strength_distribution.png'))
+    elif name == 'opening_success':
+        # 2. Opening Success Rates
+        plt.figure(figsize=(12, 6))
+        plt.barh(data['OpeningFamily'], data['white_win_rate'])
+        plt.title('White Win Rate by ECO Opening Family')
+        plt.xlabel('Win Rate')
+        plt.tight_layout()
+        plt.savefig(os.path.join(output_path, 'opening_success.png'))
+    elif name == 'time_pattern':
+        # 3. Time Control Analysis
+        plt.figure(figsize=(10, 10))
+        plt.pie(data['count'], labels=data['TimeFormat'], autopct='%1.1f%%')
+        plt.title('Distribution of Time Control Formats')
+        plt.savefig(os.path.join(output_path, 'time_control_dist.png'))
+    elif name == 'rating_hist':
+        # 4. Rating Distribution
+        edges, counts = data
+        plt.figure(figsize=(12, 6))
+        plt.bar(edges[:-1], counts, width=(edges[1] - edges[0]), align='edge')
+        plt.title('Distribution of Player Ratings')
+        plt.xlabel('Rating')
+        plt.ylabel('Frequency')
+        plt.savefig(os.path.join(output_path, 'rating_distribution.png'))
+    elif name == 'outcome_dist':
+        # 5. Game Outcomes
+        plt.figure(figsize=(10, 10))
+        plt.pie(data['count'], labels=data['Result'], autopct='%1.1f%%')
+        plt.title('Distribution of Game Outcomes')
+        plt.savefig(os.path.join(output_path, 'game_outcomes.png'))
+    plt.close()
 
 class ChessPatternAnalysis:
     def __init__(self):
         """Initialize Spark session with configurations"""
         self.spark = SparkSession.builder \
             .appName("Chess Pattern Analysis") \
-            .config("spark.sql.crossJoin.enabled", "true") \
             .config("spark.sql.adaptive.enabled", "true") \
-            .config("spark.sql.shuffle.partitions", "10") \
+            .config("spark.sql.adaptive.coalescePartitions.enabled", "true") \
+            .config("spark.sql.adaptive.localShuffleReader.enabled", "true") \
+            .config("spark.sql.adaptive.advisoryPartitionSizeInBytes", "64m") \
+            .config("spark.sql.autoBroadcastJoinThreshold", str(50 * 1024 * 1024)) \
+            .config("spark.sql.shuffle.partitions", "200") \
             .config("spark.driver.memory", "4g") \
             .config("spark.sql.warehouse.dir", "./spark-warehouse") \
             .config("spark.hadoop.mapreduce.fileoutputcommitter.algorithm.version", "2") \
+            .config("spark.sql.parquet.filterPushdown", "true") \
+            .config("spark.sql.parquet.enableVectorizedReader", "true") \
+            .config("spark.sql.execution.arrow.pyspark.enabled", "true") \
+            .config("spark.sql.execution.arrow.pyspark.fallback.enabled", "true") \
+            .config("spark.sql.execution.arrow.maxRecordsPerBatch", "50000") \
+            .config("spark.serializer", "org.apache.spark.serializer.KryoSerializer") \
+            .config("spark.sql.inMemoryColumnarStorage.compressed", "true") \
+            .config("spark.sql.inMemoryColumnarStorage.batchSize", "20000") \
             .master("local[*]") \
             .getOrCreate()
 
         # Set log level
         self.spark.sparkContext.setLogLevel("ERROR")
 
+        # Summary statistics of the loaded data, computed on first use
+        self.stats = None
+
     def process_data(self, file_path):
         """Load and process chess games with schema validation"""
         print(f"Processing data from: {file_path}")
+        self.stats = None
+
+        # Parquet copy of the CSV, written once and reused by later runs. The path carries
+        # the cache layout version; a completed cache is reused unless the CSV is present
+        # and was modified after the cache was written
+        parquet_path = os.path.splitext(file_path)[0] + f"_v{PARQUET_CACHE_VERSION}.parquet"
+        success_path = os.path.join(parquet_path, "_SUCCESS")
+        if os.path.exists(success_path) and (not os.path.exists(file_path) or
+                os.path.getmtime(success_path) >= os.path.getmtime(file_path)):
+            print(f"Reading cached Parquet from: {parquet_path}")
+            self.df = self.spark.read.parquet(parquet_path)
+            return self.df
 
-        # Define schema with correct data types
-        schema = StructType([
-            StructField("Event", StringType(), True),
-            StructField("White", StringType(), True),
-            StructField("Black", StringType(), True),
-            StructField("Result", StringType(), True),
-            StructField("UTCDate", StringType(), True),
-            StructField("UTCTime", StringType(), True),
-            StructField("WhiteElo", IntegerType(), True),
-            StructField("BlackElo", IntegerType(), True),
-            StructField("WhiteRatingDiff", IntegerType(), True),
-            StructField("BlackRatingDiff", IntegerType(), True),
-            StructField("ECO", StringType(), True),
-            StructField("Opening", StringType(), True),
-            StructField("TimeControl", StringType(), True),
-            StructField("Termination", StringType(), True)
+        # Define schema with correct data types. Rating columns are read as strings
+        # and cast in Spark, so malformed cells become nulls instead of failing the ingest
+        rating_columns = ["WhiteElo", "BlackElo", "WhiteRatingDiff", "BlackRatingDiff"]
+        schema = pa.schema([
+            pa.field("Event", pa.string()),
+            pa.field("White", pa.string()),
+            pa.field("Black", pa.string()),
+            pa.field("Result", pa.string()),
+            pa.field("UTCDate", pa.string()),
+            pa.field("UTCTime", pa.string()),
+            pa.field("WhiteElo", pa.string()),
+            pa.field("BlackElo", pa.string()),
+            pa.field("WhiteRatingDiff", pa.string()),
+            pa.field("BlackRatingDiff", pa.string()),
+            pa.field("ECO", pa.string()),
+            pa.field("Opening", pa.string()),
+            pa.field("TimeControl", pa.string()),
+            pa.field("Termination", pa.string())
         ])
 
-        # Load and clean data
-        self.df = self.spark.read.csv(file_path, header=True, schema=schema)
-        
-        # Handle missing values
-        self.df = self.df.na.fill({
-            'WhiteElo': 0,
-            'BlackElo': 0,
-            'WhiteRatingDiff': 0,
-            'BlackRatingDiff': 0
-        })
-
-        # Create derived columns
-        self.df = self.df \
-            .withColumn("StrengthCategory",
-                when(col("WhiteElo") >= 2400, "Master")
-                .when(col("WhiteElo") >= 2000, "Expert")
-                .when(col("WhiteElo") >= 1600, "Club")
-                .otherwise("Beginner")) \
-            .withColumn("OpeningFamily",
-                regexp_extract(col("Opening"), "^[^:]+", 0)) \
-            .withColumn("Date", 
-                to_date(col("UTCDate"), "yyyy.MM.dd")) \
-            .withColumn("TimeFormat",
-                when(col("TimeControl").contains("+"), "Increment")
-                .when(col("TimeControl").contains("|"), "Tournament")
-                .otherwise("Standard"))
-
-        print(f"Processed {self.df.count():,} games")
+        # Parse the CSV with Arrow's native reader, streaming batches into a staging Parquet file.
+        # Only the schema columns are kept; extra columns such as the move list are skipped,
+        # and empty cells become nulls as with Spark's CSV reader
+        raw_path = os.path.splitext(file_path)[0] + "_raw.parquet"
+        skipped_rows = []
+        def skip_invalid_row(row):
+            skipped_rows.append(row.number)
+            return "skip"
+
+        try:
+            reader = pv.open_csv(file_path,
+                parse_options=pv.ParseOptions(invalid_row_handler=skip_invalid_row),
+                convert_options=pv.ConvertOptions(
+                    column_types=schema,
+                    include_columns=schema.names,
+                    strings_can_be_null=True))
+            with pq.ParquetWriter(raw_path, reader.schema) as writer:
+                for batch in reader:
+                    writer.write_batch(batch)
+            if skipped_rows:
+                print(f"Skipped {len(skipped_rows):,} malformed CSV rows")
+
+            # Load and clean data
+            self.df = self.spark.read.parquet(raw_path)
+            # Only signed values of at most five digits are cast, and only those within
+            # ShortType's range are kept, so no cast can overflow even under ANSI mode
+            for name in rating_columns:
+                value = when(trim(col(name)).rlike("^[+-]?[0-9]{1,5}$"), trim(col(name)).cast("int"))
+                self.df = self.df.withColumn(name,
+                    when(value.between(-32768, 32767), value.cast(ShortType())))
+
+            # Handle missing values
+            self.df = self.df.na.fill({name: 0 for name in rating_columns})
+
+            # Create derived columns
+            self.df = self.df \
+                .withColumn("StrengthCategory",
+                    when(col("WhiteElo") >= 2400, 0)
+                    .when(col("WhiteElo") >= 2000, 1)
+                    .when(col("WhiteElo") >= 1600, 2)
+                    .otherwise(3).cast(ByteType())) \
+                .withColumn("OpeningFamily",
+                    col("ECO").substr(1, 1)) \
+                .withColumn("TimeFormat",
+                    when(col("TimeControl").contains("+"), 0)
+                    .when(col("TimeControl").contains("|"), 1)
+                    .otherwise(2).cast(ByteType()))
+
+            # Convert to Parquet so later reads only touch the projected columns,
+            # partitioned by the five-value OpeningFamily key
+            self.df.write.mode("overwrite").partitionBy("OpeningFamily").parquet(parquet_path)
+        finally:
+            if os.path.exists(raw_path):
+                os.remove(raw_path)
+
+        self.df = self.spark.read.parquet(parquet_path)
         return self.df
+
+    def summary_stats(self):
+        """Compute summary statistics of the loaded data in a single pass"""
+        if self.stats is None:
+            self.stats = self.df.agg(
+                count("*").alias("n"),
+                approx_count_distinct("Opening", 0.02).alias("uo"),
+                avg("WhiteElo").alias("ar"),
+                min("WhiteElo").alias("lo"),
+                max("WhiteElo").alias("hi")
+            ).first()
+        return self.stats
+
     def analyze_playing_patterns(self, df):
         """Analyze chess playing patterns"""
         print("Analyzing playing patterns...")
         try:
             # Pattern 1: Opening preferences by rating level
-            opening_patterns = df.groupBy("StrengthCategory", "OpeningFamily") \
-                .agg(count("*").alias("Count")) \
-                .withColumn("Percentage",
-                    col("Count") / sum("Count").over(Window.partitionBy("StrengthCategory")) * 100)
+            # Category totals are rolled up from the grouped counts, so the data is scanned once
+            opening_counts = df.select("StrengthCategory", "OpeningFamily") \
+                .groupBy("StrengthCategory", "OpeningFamily") \
+                .agg(count("*").alias("Count"))
+            category_totals = opening_counts.groupBy("StrengthCategory") \
+                .agg(sum("Count").alias("Total"))
+            opening_patterns = opening_counts \
+                .join(broadcast(category_totals), "StrengthCategory") \
+                .withColumn("Percentage", col("Count") / col("Total") * 100) \
+                .drop("Total") \
+                .withColumn("StrengthCategory", label_column("StrengthCategory", STRENGTH_LABELS))
 
             # Pattern 2: Time management analysis
-            time_patterns = df.groupBy("TimeFormat", "StrengthCategory") \
+            time_patterns = df.select("TimeFormat", "StrengthCategory", "WhiteElo") \
+                .groupBy("TimeFormat", "StrengthCategory") \
                 .agg(
                     count("*").alias("GamesCount"),
                     avg("WhiteElo").alias("AverageRating")
-                )
+                ) \
+                .withColumn("TimeFormat", label_column("TimeFormat", TIME_FORMAT_LABELS)) \
+                .withColumn("StrengthCategory", label_column("StrengthCategory", STRENGTH_LABELS))
 
             return opening_patterns, time_patterns
         except Exception as e:
             print(f"Error in pattern analysis: {str(e)}")
             raise
 
-    def visualize_and_save_results(self, output_path):
+    def visualize_and_save_results(self, output_path, parallel_render=False):
         """Create visualizations and save analysis results"""
         print("Creating visualizations and saving results...")
         
@@ -108,60 +265,58 @@ class ChessPatternAnalysis:
             # Create output directory
             os.makedirs(output_path, exist_ok=True)
 
-            # 1. Player Strength Distribution
-            plt.figure(figsize=(12, 6))
-            strength_dist = self.df.groupBy("StrengthCategory").count().toPandas()
-            plt.bar(strength_dist['StrengthCategory'], strength_dist['count'])
-            plt.title('Distribution of Player Strength Categories')
-            plt.xlabel('Strength Category')
-            plt.ylabel('Number of Players')
-            plt.xticks(rotation=45)
-            plt.tight_layout()
-            plt.savefig(os.path.join(output_path, 'strength_distribution.png'))
-            plt.close()
-
-            # 2. Opening Success Rates
-            opening_success = self.df.groupBy("OpeningFamily") \
-                .agg(
-                    count("*").alias("games_count"),
-                    avg(when(col("Result") == "1-0", 1).otherwise(0)).alias("white_win_rate")
-                ) \
-                .orderBy(desc("games_count")) \
-                .limit(10) \
-                .toPandas()
-
-            plt.figure(figsize=(12, 6))
-            plt.barh(opening_success['OpeningFamily'], opening_success['white_win_rate'])
-            plt.title('Top 10 Openings White Win Rate')
-            plt.xlabel('Win Rate')
-            plt.tight_layout()
-            plt.savefig(os.path.join(output_path, 'opening_success.png'))
-            plt.close()
-
-            # 3. Time Control Analysis
-            time_pattern = self.df.groupBy("TimeFormat").count().toPandas()
-            plt.figure(figsize=(10, 10))
-            plt.pie(time_pattern['count'], labels=time_pattern['TimeFormat'], autopct='%1.1f%%')
-            plt.title('Distribution of Time Control Formats')
-            plt.savefig(os.path.join(output_path, 'time_control_dist.png'))
-            plt.close()
-
-            # 4. Rating Distribution
-            plt.figure(figsize=(12, 6))
-            plt.hist(self.df.select('WhiteElo').toPandas(), bins=50)
-            plt.title('Distribution of Player Ratings')
-            plt.xlabel('Rating')
-            plt.ylabel('Frequency')
-            plt.savefig(os.path.join(output_path, 'rating_distribution.png'))
-            plt.close()
-
-            # 5. Game Outcomes
-            outcome_dist = self.df.groupBy("Result").count().toPandas()
-            plt.figure(figsize=(10, 10))
-            plt.pie(outcome_dist['count'], labels=outcome_dist['Result'], autopct='%1.1f%%')
-            plt.title('Distribution of Game Outcomes')
-            plt.savefig(os.path.join(output_path, 'game_outcomes.png'))
-            plt.close()
+            # Chart-only aggregations run on a 10% sample; counts are scaled back up
+            sample_fraction = 0.1
+            viz_df = self.df.sample(sample_fraction, seed=42)
+            stats = self.summary_stats()
+
+            # Independent aggregations over the cached data, submitted as concurrent Spark jobs
+            aggregations = {
+                # 1. Player Strength Distribution
+                'strength_dist': lambda: collect_columns(
+                    viz_df.select("StrengthCategory").groupBy("StrengthCategory")
+                    .agg((count("*") / sample_fraction).cast("long").alias("count"))),
+                # 2. Opening Success Rates
+                'opening_success': lambda: self.df.select("OpeningFamily", "Result") \
+                    .groupBy("OpeningFamily") \
+                    .agg(
+                        count("*").alias("games_count"),
+                        (sum((col("Result") == "1-0").cast("int")) / count("*")).alias("white_win_rate")
+                    ) \
+                    .orderBy(desc("games_count")) \
+                    .limit(10) \
+                    .toPandas(),
+                # 3. Time Control Analysis
+                'time_pattern': lambda: collect_columns(
+                    self.df.select("TimeFormat").groupBy("TimeFormat").count()),
+                # 4. Rating Distribution (binned in Spark, only the bin counts reach the driver)
+                'rating_hist': lambda: histogram(self.df, "WhiteElo", stats.lo, stats.hi, 50),
+                # 5. Game Outcomes
+                'outcome_dist': lambda: collect_columns(
+                    self.df.select("Result").groupBy("Result").count())
+            }
+            with ThreadPoolExecutor(max_workers=len(aggregations)) as executor:
+                futures = {name: executor.submit(job) for name, job in aggregations.items()}
+                collected = {name: future.result() for name, future in futures.items()}
+
+            strength_dist = collected['strength_dist']
+            opening_success = collected['opening_success']
+            time_pattern = collected['time_pattern']
+            outcome_dist = collected['outcome_dist']
+
+            strength_dist['StrengthCategory'] = [STRENGTH_LABELS[c] for c in strength_dist['StrengthCategory']]
+            time_pattern['TimeFormat'] = [TIME_FORMAT_LABELS[c] for c in time_pattern['TimeFormat']]
+
+            # Render the charts, optionally in spawned worker processes. Forking would copy
+            # the threaded Spark driver, and each spawned worker re-imports this module,
+            # so the pool only pays off when chart rendering outweighs that startup
+            chart_args = [(name, data, output_path) for name, data in collected.items()]
+            if parallel_render:
+                with multiprocessing.get_context("spawn").Pool(len(chart_args)) as pool:
+                    pool.starmap(_render_chart, chart_args)
+            else:
+                for args in chart_args:
+                    _render_chart(*args)
 
             # Save numerical results
             results = {
@@ -171,19 +326,19 @@ class ChessPatternAnalysis:
             }
 
             for name, data in results.items():
-                data.to_csv(os.path.join(output_path, f"{name}.csv"), index=False)
+                pd.DataFrame(data).to_csv(os.path.join(output_path, f"{name}.csv"), index=False)
 
             # Print key findings
             print("\nKey Findings:")
-            print(f"- Total games analyzed: {self.df.count():,}")
-            print(f"- Unique openings: {self.df.select('Opening').distinct().count():,}")
-            print(f"- Average player rating: {self.df.select(avg('WhiteElo')).collect()[0][0]:.0f}")
+            print(f"- Total games analyzed: {stats.n:,}")
+            print(f"- Unique openings (approx.): {stats.uo:,}")
+            print(f"- Average player rating: {stats.ar:.0f}")
 
         except Exception as e:
             print(f"Error in visualization: {str(e)}")
             raise
 
-    def run_pipeline(self, input_path, output_path):
+    def run_pipeline(self, input_path, output_path, parallel_render=False):
         """Execute the complete analysis pipeline"""
         try:
             print("\nStarting Chess Pattern Analysis Pipeline...")
@@ -191,10 +346,12 @@ class ChessPatternAnalysis:
 
             # Process and cache data
             self.df = self.process_data(input_path)
-            self.df.cache()
+            self.df.persist(StorageLevel.MEMORY_ONLY)
+
+            print(f"Processed {self.summary_stats().n:,} games")
 
             # Create visualizations and save results
-            self.visualize_and_save_results(output_path)
+            self.visualize_and_save_results(output_path, parallel_render)
 
             print("\nAnalysis completed successfully!")
             print("=" * 50)